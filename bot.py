@@ -1,19 +1,29 @@
 #!/usr/bin/env python3
 """
 Telegram PDF Utility Bot - v20+ (async)
-- Queue system
+- Process pool for PDF work
 - Progress bar
 - Page count
 - Compress, split, merge, rotate, extract
 - Remove watermark using keywords from .env or GitHub Secrets
 """
 
+import gc
 import os
+import re
 import time
+import asyncio
+import pickle
+import shutil
+import hashlib
+import tempfile
 import fitz  # PyMuPDF
-from queue import Queue
-from threading import Thread
-from functools import wraps
+import aiofiles
+from queue import Empty
+from multiprocessing import Manager, cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from functools import wraps, lru_cache
+from collections import Counter, OrderedDict
 from dotenv import load_dotenv
 
 from telegram import Update
@@ -22,20 +32,42 @@ from telegram.ext import (
 )
 from PyPDF2 import PdfReader, PdfWriter
 
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # ----------------------------
 # Load environment variables
 # ----------------------------
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
-WATERMARK_KEYWORDS = [k.strip().upper() for k in os.getenv("WATERMARK_KEYWORDS", "").split(",") if k.strip()]
+WATERMARK_KEYWORDS = tuple(k.strip().upper() for k in os.getenv("WATERMARK_KEYWORDS", "").split(",") if k.strip())
+# Only consider rotated text (diagonal/vertical stamps) as watermark candidates
+WATERMARK_ROTATED_ONLY = os.getenv("WATERMARK_ROTATED_ONLY", "").strip().lower() in ("1", "true", "yes")
 
 # ----------------------------
 # Global vars
 # ----------------------------
 WORK = "pdf_files"
+WORK_MAX_BYTES = int(os.getenv("WORK_MAX_BYTES", 2 * 1024 ** 3))
+CACHE_DIR = os.path.join(WORK, ".cache")
 MERGE_QUEUE = []
-os.makedirs(WORK, exist_ok=True)
-job_queue = Queue()
+os.makedirs(CACHE_DIR, exist_ok=True)
+EXEC = None     # ProcessPoolExecutor for blocking PDF work (PyMuPDF isn't thread-safe)
+MANAGER = None  # multiprocessing.Manager carrying progress out of EXEC
+# abspath -> number of running /clean jobs using it (their input and job dir);
+# evict_work never touches these
+ACTIVE_PATHS = Counter()
+
+# Parse caches keyed by the MD5 of the PDF contents
+CACHE_SIZE = 64
+PAGE_COUNTS = OrderedDict()  # pdf_hash -> page count
+# (pdf_hash, page_no) -> {"text": page text, "spans": [(text, bbox, dir), ...]}
+# "spans" is only filled in for pages whose text matched a keyword. Bump
+# TEXT_CACHE_VERSION whenever that shape changes so old .pkl files are ignored.
+TEXT_CACHE = OrderedDict()
+TEXT_CACHE_VERSION = 1
 
 # ----------------------------
 # Helpers
@@ -47,64 +79,266 @@ def human_readable_size(num_bytes):
         num_bytes /= 1024.0
     return f"{num_bytes:.1f} PB"
 
-def get_page_count(pdf_path):
+# match(text) -> True if any keyword occurs in `text`, ignoring case.
+# All keywords are compiled into one Aho-Corasick automaton when
+# pyahocorasick is installed, otherwise into one regex alternation, so each
+# span is scanned in a single pass either way.
+@lru_cache(maxsize=8)
+def keyword_matcher(keywords):
+    if not keywords:
+        return lambda text: False
+    if ahocorasick:
+        automaton = ahocorasick.Automaton()
+        for k in keywords:
+            automaton.add_word(k.upper(), k)
+        automaton.make_automaton()
+        return lambda text: next(automaton.iter(text.upper()), None) is not None
+    pattern = re.compile("|".join(re.escape(k) for k in keywords), re.I)
+    return lambda text: pattern.search(text) is not None
+
+def lru_put(cache, key, value, maxsize=CACHE_SIZE):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > maxsize:
+        cache.popitem(last=False)
+
+# `pdf` is a path or the file's bytes
+def get_page_count(pdf, pdf_hash=None):
+    if pdf_hash in PAGE_COUNTS:
+        PAGE_COUNTS.move_to_end(pdf_hash)
+        return PAGE_COUNTS[pdf_hash]
     try:
-        reader = PdfReader(pdf_path)
-        return len(reader.pages)
+        if isinstance(pdf, (bytes, bytearray)):
+            doc = fitz.open(stream=pdf, filetype="pdf")
+        else:
+            doc = fitz.open(pdf)
+        pages = doc.page_count
+        doc.close()
     except:
         return None
+    if pdf_hash:
+        lru_put(PAGE_COUNTS, pdf_hash, pages)
+    return pages
+
+def text_cache_path(pdf_hash):
+    return os.path.join(CACHE_DIR, f"{pdf_hash}.v{TEXT_CACHE_VERSION}.pkl")
+
+def _read_text_cache(pdf_hash):
+    path = text_cache_path(pdf_hash)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except:
+        return {}
+
+# Cached entries for `page_nos` of `pdf_hash`: the in-memory LRU first, then
+# WORK/.cache/{hash}.v{N}.pkl (which survives restarts) only for pages the LRU
+# is missing. This runs inside EXEC, so each worker warms its own LRU.
+def load_page_text(pdf_hash, page_nos):
+    pages = {}
+    for page_no in page_nos:
+        entry = TEXT_CACHE.get((pdf_hash, page_no))
+        if entry is not None:
+            TEXT_CACHE.move_to_end((pdf_hash, page_no))
+            pages[page_no] = entry
+    if len(pages) < len(page_nos):
+        on_disk = _read_text_cache(pdf_hash)
+        for page_no in page_nos:
+            if page_no not in pages and page_no in on_disk:
+                pages[page_no] = on_disk[page_no]
+                lru_put(TEXT_CACHE, (pdf_hash, page_no), on_disk[page_no])
+    return pages
 
-def progress_bar(message, total_steps=30, action="Processing", speed=0.08):
+def store_page_text(pdf_hash, new_pages):
+    if not new_pages:
+        return
+    for page_no, entry in new_pages.items():
+        lru_put(TEXT_CACHE, (pdf_hash, page_no), entry)
+    pages = _read_text_cache(pdf_hash)
+    pages.update(new_pages)
+    path = text_cache_path(pdf_hash)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(pages, f)
+    os.replace(tmp, path)
+
+# Delete the least recently used files under WORK until it fits in max_bytes.
+# Files are touched when used, so mtime also counts on noatime mounts. `keep`
+# (the caller's input) and ACTIVE_PATHS are never deleted, even if they alone
+# are over the cap.
+def evict_work(max_bytes=WORK_MAX_BYTES, keep=None):
+    skip = set(ACTIVE_PATHS)
+    if keep:
+        skip.add(os.path.abspath(keep))
+    files = []
+    for root, dirs, names in os.walk(WORK):
+        for name in names:
+            path = os.path.abspath(os.path.join(root, name))
+            if path in skip or os.path.dirname(path) in skip:
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+# report(i, n) callback for the PDF operations; edits `message` on `loop`
+# at most once per `interval` seconds (the last step is always shown) and
+# returns the scheduled edit's future, or None when throttled
+def make_progress(message, loop, action="Processing", interval=1.0):
     bar_length = 20
-    for step in range(1, total_steps + 1):
-        filled = int(bar_length * step / total_steps)
+    last_ts = 0.0
+    def report(i, n):
+        nonlocal last_ts
+        now = time.monotonic()
+        if i < n and now - last_ts < interval:
+            return
+        last_ts = now
+        filled = int(bar_length * i / n) if n else bar_length
         bar = "█" * filled + "-" * (bar_length - filled)
-        percent = int((step / total_steps) * 100)
-        text = f"{action}: [{bar}] {percent}%"
-        try:
-            message.edit_text(text)
-        except:
-            pass
-        time.sleep(speed)
+        text = f"{action}: [{bar}] {i}/{n}"
+        return asyncio.run_coroutine_threadsafe(message.edit_text(text), loop)
+    return report
 
 # ----------------------------
 # PDF operations
 # ----------------------------
-def remove_watermark(input_pdf, output_pdf, keywords=None):
-    if keywords is None:
-        keywords = WATERMARK_KEYWORDS
+# Page-range workers. Called inline they cover the whole document; run_shards
+# fans one slice per CPU out over EXEC. fitz documents can't be pickled, so
+# every shard re-opens the file by name and works on its own
+# [seg_from, seg_to) slice.
+def _shard_count(page_count):
+    cpu = max(1, min(cpu_count(), page_count))
+    seg = -(-page_count // cpu)
+    # Rounding the slice size up can leave trailing shards with no pages
+    # (6 pages on 4 CPUs is 3 slices of 2), so only count the ones in use
+    return -(-page_count // seg) if seg else 1
+
+def _page_range(idx, cpu, page_count):
+    seg = -(-page_count // cpu)
+    return idx * seg, min((idx + 1) * seg, page_count)
+
+def _page_spans(page):
+    spans = []
+    for block in page.get_text("dict")["blocks"]:
+        if block.get("type") != 0:
+            continue
+        for line in block.get("lines", []):
+            line_dir = tuple(line.get("dir", (1, 0)))
+            for span in line.get("spans", []):
+                bbox = span.get("bbox")
+                if bbox:
+                    spans.append((span.get("text", ""), tuple(bbox), line_dir))
+    return spans
+
+def _is_horizontal(line_dir):
+    return line_dir[0] > 0 and abs(line_dir[1]) < 1e-3
+
+# Read-only keyword scan of one page slice. Returns the span bboxes to redact
+# per page, plus the cache entries it had to extract.
+def _scan_range(vec, report=None):
+    idx, cpu, input_pdf, keywords, pdf_hash, rotated_only = vec
+    match = keyword_matcher(tuple(keywords))
+    new_text = {}
+    hits = {}
     doc = fitz.open(input_pdf)
-    for page in doc:
+    total = doc.page_count
+    seg_from, seg_to = _page_range(idx, cpu, total)
+    cached = load_page_text(pdf_hash, range(seg_from, seg_to)) if pdf_hash else {}
+    for i in range(seg_from, seg_to):
+        page = doc[i]
         try:
-            blocks = page.get_text("dict")["blocks"]
-            for block in blocks:
-                if block.get("type") != 0:
-                    continue
-                for line in block.get("lines", []):
-                    for span in line.get("spans", []):
-                        text = span.get("text", "").upper()
-                        if any(k in text for k in keywords):
-                            bbox = span.get("bbox")
-                            if bbox:
-                                page.add_redact_annot(bbox, fill=(1,1,1))
-        except:
-            pass
-        try:
-            images = page.get_images(full=True)
-            for img in images:
-                try:
-                    page.delete_image(img[0])
-                except:
-                    pass
+            # Plain page text first; the much heavier "dict" parse is only
+            # needed to locate span bboxes on pages that contain a keyword
+            entry = dict(cached.get(i, {}))
+            if "text" not in entry:
+                entry["text"] = page.get_text("text")
+                new_text[i] = entry
+            if match(entry["text"]):
+                if "spans" not in entry:
+                    # Canonical operators let MuPDF merge over-fragmented text
+                    # showings into whole spans. This only touches the scan's
+                    # own copy of the document, which is never saved.
+                    try:
+                        page.clean_contents(sanitize=True)
+                    except:
+                        pass
+                    entry["spans"] = _page_spans(page)
+                    new_text[i] = entry
+                for text, bbox, line_dir in entry["spans"]:
+                    if rotated_only and _is_horizontal(line_dir):
+                        continue
+                    if match(text):
+                        hits.setdefault(i, []).append(bbox)
         except:
             pass
+        if report:
+            report(i + 1, total)
+    doc.close()
+    return hits, new_text
+
+# Apply all redactions on one document and save it once, so links, forms,
+# page labels and shared resources survive untouched
+def _redact_pdf(input_pdf, output_pdf, hits, remove_images=False):
+    doc = fitz.open(input_pdf)
+    if remove_images:
+        removed_images = set()  # xrefs are shared between pages; delete each once
+        for page in doc:
+            try:
+                for info in page.get_image_info(xrefs=True):
+                    xref = info.get("xref")
+                    if xref and xref not in removed_images:
+                        page.delete_image(xref)
+                        removed_images.add(xref)
+            except:
+                pass
+    for i in sorted(hits):
+        page = doc[i]
+        for bbox in hits[i]:
+            page.add_redact_annot(fitz.Rect(bbox), fill=(1,1,1))
+        # Images under a hit are dropped from this page's content only; the
+        # same image drawn on other pages stays
         try:
-            page.apply_redactions()
+            page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_REMOVE)
         except:
             pass
     doc.save(output_pdf)
     doc.close()
 
+def _merge_scans(results):
+    hits, new_text = {}, {}
+    for shard_hits, shard_text in results:
+        hits.update(shard_hits)
+        new_text.update(shard_text)
+    return hits, new_text
+
+# Fill in the env-configured defaults for remove_watermark / clean_pdf
+def _watermark_options(keywords=None, rotated_only=None):
+    if keywords is None:
+        keywords = WATERMARK_KEYWORDS
+    if rotated_only is None:
+        rotated_only = WATERMARK_ROTATED_ONLY
+    return keywords, rotated_only
+
+def remove_watermark(input_pdf, output_pdf, keywords=None, report=None, pdf_hash=None, rotated_only=None,
+                     remove_images=False):
+    keywords, rotated_only = _watermark_options(keywords, rotated_only)
+    hits, new_text = _scan_range((0, 1, input_pdf, keywords, pdf_hash, rotated_only), report)
+    if pdf_hash:
+        store_page_text(pdf_hash, new_text)
+    _redact_pdf(input_pdf, output_pdf, hits, remove_images)
+
 def compress_pdf(input_pdf, output_pdf):
     doc = fitz.open(input_pdf)
     try:
@@ -119,63 +353,196 @@ def compress_pdf(input_pdf, output_pdf):
     finally:
         doc.close()
 
-def split_pdf(input_pdf, out_folder):
-    reader = PdfReader(input_pdf)
+def _split_range(vec, report=None):
+    idx, cpu, input_pdf, out_folder = vec
+    doc = fitz.open(input_pdf)
+    total = doc.page_count
+    seg_from, seg_to = _page_range(idx, cpu, total)
     out_paths = []
-    for i, page in enumerate(reader.pages, start=1):
-        writer = PdfWriter()
-        writer.add_page(page)
-        out_path = os.path.join(out_folder, f"page_{i}.pdf")
-        with open(out_path, "wb") as f:
-            writer.write(f)
+    for i in range(seg_from, seg_to):
+        out = fitz.open()
+        out.insert_pdf(doc, from_page=i, to_page=i)
+        out_path = os.path.join(out_folder, f"page_{i + 1}.pdf")
+        out.save(out_path)  # insert_pdf only copies what the page uses; no garbage pass needed
+        out.close()
         out_paths.append(out_path)
+        if report:
+            report(i + 1, total)
+    doc.close()
     return out_paths
 
+def split_pdf(input_pdf, out_folder, report=None):
+    return _split_range((0, 1, input_pdf, out_folder), report)
+
 def merge_pdfs(file_list, output_path):
-    writer = PdfWriter()
-    for file in file_list:
-        reader = PdfReader(file)
-        for p in reader.pages:
-            writer.add_page(p)
-    with open(output_path, "wb") as f:
-        writer.write(f)
+    out = fitz.open()
+    try:
+        # Free each source as soon as it is copied so peak memory tracks
+        # the output, not output + every input
+        for file in file_list:
+            src = fitz.open(file)
+            out.insert_pdf(src)
+            src.close()
+            del src
+            if len(out) > 500:
+                gc.collect()
+        out.save(output_path, garbage=3, deflate=True)
+    except:
+        writer = PdfWriter()
+        for file in file_list:
+            writer.append(file)
+        with open(output_path, "wb") as f:
+            writer.write(f)
+    finally:
+        out.close()
 
 def rotate_pdf(input_pdf, output_pdf, angle=90):
-    reader = PdfReader(input_pdf)
-    writer = PdfWriter()
-    for page in reader.pages:
-        page.rotate(angle)
-        writer.add_page(page)
-    with open(output_pdf, "wb") as f:
-        writer.write(f)
-
-def extract_images(input_pdf, out_folder, dpi=150):
     doc = fitz.open(input_pdf)
+    try:
+        for page in doc:
+            page.set_rotation((page.rotation + angle) % 360)
+        doc.save(output_pdf, garbage=1, deflate=True)
+    except:
+        reader = PdfReader(input_pdf)
+        writer = PdfWriter()
+        for page in reader.pages:
+            page.rotate(angle)
+            writer.add_page(page)
+        with open(output_pdf, "wb") as f:
+            writer.write(f)
+    finally:
+        doc.close()
+
+def _render_range(vec, report=None):
+    idx, cpu, input_pdf, dpi, out_folder = vec
+    doc = fitz.open(input_pdf)
+    total = doc.page_count
+    seg_from, seg_to = _page_range(idx, cpu, total)
     out_files = []
-    for i, page in enumerate(doc, start=1):
-        pix = page.get_pixmap(dpi=dpi)
-        img_path = os.path.join(out_folder, f"page_{i}.png")
-        pix.save(img_path)
+    for i in range(seg_from, seg_to):
+        pix = doc[i].get_pixmap(dpi=dpi)
+        if pix.alpha:
+            pix = fitz.Pixmap(pix, 0)  # JPEG has no alpha channel
+        img_path = os.path.join(out_folder, f"page_{i + 1}.jpg")
+        with open(img_path, "wb") as f:
+            f.write(pix.tobytes("jpeg", jpg_quality=80))
+        pix = None  # free the samples before rendering the next page
         out_files.append(img_path)
+        if report:
+            report(i + 1, total)
     doc.close()
     return out_files
 
+def extract_images(input_pdf, out_folder, dpi=150, report=None):
+    return _render_range((0, 1, input_pdf, dpi, out_folder), report)
+
 # ----------------------------
-# Queue system
+# Process pool
 # ----------------------------
-def worker():
-    while True:
-        task = job_queue.get()
-        try:
-            task()
-        except Exception as e:
-            print("Error in job:", e)
-        job_queue.task_done()
+# Picklable stand-in for a report(i, n) callback inside EXEC
+class QueueReport:
+    def __init__(self, queue):
+        self.queue = queue
+
+    def __call__(self, i, n):
+        self.queue.put((i, n))
 
-Thread(target=worker, daemon=True).start()
+# Run a blocking PDF operation in EXEC without stalling the event loop.
+# `report` stays in this process; the job's progress is relayed to it.
+async def run_cpu(func, *args, report=None, **kwargs):
+    if report is None:
+        return await asyncio.wrap_future(EXEC.submit(func, *args, **kwargs))
+    progress = MANAGER.Queue()
+    fut = asyncio.wrap_future(EXEC.submit(func, *args, report=QueueReport(progress), **kwargs))
+    while not fut.done():
+        await asyncio.wait({fut}, timeout=0.5)
+        while True:
+            try:
+                i, n = progress.get_nowait()
+            except Empty:
+                break
+            await _relay(report, i, n)
+    return fut.result()
 
-def enqueue(task_callable):
-    job_queue.put(task_callable)
+async def _relay(report, i, n):
+    pending = report(i, n)
+    if pending:
+        # Wait for the edit so it can't land after the caller's own
+        # "done" message
+        await asyncio.gather(asyncio.wrap_future(pending), return_exceptions=True)
+
+# Fan one job's page shards out over EXEC (no per-job Pool); results come
+# back in shard order and `report` advances as each shard finishes
+async def run_shards(func, vectors, total, report=None):
+    if len(vectors) == 1:
+        return [await run_cpu(func, vectors[0], report=report)]
+    async def shard(idx, vec):
+        return idx, await asyncio.wrap_future(EXEC.submit(func, vec))
+    results = [None] * len(vectors)
+    done = 0
+    for next_shard in asyncio.as_completed([shard(idx, vec) for idx, vec in enumerate(vectors)]):
+        idx, result = await next_shard
+        results[idx] = result
+        seg_from, seg_to = _page_range(idx, len(vectors), total)
+        done += seg_to - seg_from
+        if report:
+            await _relay(report, done, total)
+    return results
+
+# get_page_count without blocking the event loop. A miss is opened in EXEC,
+# whose PAGE_COUNTS lives in the worker, so the count is cached here
+async def get_page_count_async(input_pdf, pdf_hash=None):
+    if pdf_hash in PAGE_COUNTS:
+        PAGE_COUNTS.move_to_end(pdf_hash)
+        return PAGE_COUNTS[pdf_hash]
+    pages = await run_cpu(get_page_count, input_pdf)
+    if pages is not None and pdf_hash:
+        lru_put(PAGE_COUNTS, pdf_hash, pages)
+    return pages
+
+# remove_watermark for the bot: the scan is sharded over EXEC, then one job
+# redacts and saves the whole document
+async def clean_pdf(input_pdf, output_pdf, keywords=None, report=None, pdf_hash=None, rotated_only=None,
+                    remove_images=False):
+    keywords, rotated_only = _watermark_options(keywords, rotated_only)
+    total = await get_page_count_async(input_pdf, pdf_hash)
+    if total is None:
+        raise ValueError(f"cannot read {input_pdf}")
+    cpu = _shard_count(total)
+    vectors = [(idx, cpu, input_pdf, keywords, pdf_hash, rotated_only) for idx in range(cpu)]
+    hits, new_text = _merge_scans(await run_shards(_scan_range, vectors, total, report))
+    if pdf_hash and new_text:
+        await run_cpu(store_page_text, pdf_hash, new_text)
+    await run_cpu(_redact_pdf, input_pdf, output_pdf, hits, remove_images)
+
+# split_pdf / extract_images for the bot, one page slice per shard
+async def split_pdf_async(input_pdf, out_folder, report=None):
+    total = await get_page_count_async(input_pdf)
+    if total is None:
+        raise ValueError(f"cannot read {input_pdf}")
+    cpu = _shard_count(total)
+    vectors = [(idx, cpu, input_pdf, out_folder) for idx in range(cpu)]
+    return [path for paths in await run_shards(_split_range, vectors, total, report) for path in paths]
+
+async def extract_images_async(input_pdf, out_folder, dpi=150, report=None):
+    total = await get_page_count_async(input_pdf)
+    if total is None:
+        raise ValueError(f"cannot read {input_pdf}")
+    cpu = _shard_count(total)
+    vectors = [(idx, cpu, input_pdf, dpi, out_folder) for idx in range(cpu)]
+    return [path for paths in await run_shards(_render_range, vectors, total, report) for path in paths]
+
+# One long-lived pool for the whole run, so commands don't pay process startup
+async def post_init(app):
+    global EXEC, MANAGER
+    EXEC = ProcessPoolExecutor(max_workers=max(2, cpu_count() - 1))
+    MANAGER = Manager()
+
+async def post_shutdown(app):
+    if EXEC:
+        EXEC.shutdown(cancel_futures=True)
+    if MANAGER:
+        MANAGER.shutdown()
 
 # ----------------------------
 # Telegram bot decorators
@@ -205,16 +572,29 @@ async def handle_pdf_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not doc or not doc.file_name.lower().endswith(".pdf"):
         await update.message.reply_text("Please upload a PDF file.")
         return
-    safe_name = f"{update.message.from_user.id}_{int(time.time())}_{doc.file_name}"
-    local_path = os.path.join(WORK, safe_name)
     await update.message.reply_text("Downloading your PDF...")
     file = await doc.get_file()
-    await file.download_to_drive(local_path)
+    # One download into memory feeds both the hash and the disk write
+    data = await file.download_as_bytearray()
+    pdf_hash = hashlib.md5(data).hexdigest()
+    # Stored by content hash, so re-uploads of the same PDF share one file
+    local_path = os.path.join(WORK, f"{pdf_hash}.pdf")
+    try:
+        os.utime(local_path)  # already stored: just mark it as used
+    except FileNotFoundError:
+        fd, tmp = tempfile.mkstemp(dir=WORK, suffix=".tmp")
+        os.close(fd)
+        async with aiofiles.open(tmp, "wb") as f:
+            await f.write(data)
+        os.replace(tmp, local_path)
+    await asyncio.to_thread(evict_work, keep=local_path)
     context.user_data["last_pdf"] = local_path
-    pages = get_page_count(local_path)
-    size = os.path.getsize(local_path)
+    context.user_data["pdf_hash"] = pdf_hash
+    context.user_data["pdf_name"] = doc.file_name
+    pages = await get_page_count_async(local_path, pdf_hash)
+    size = len(data)
     await update.message.reply_text(
-        f"📄 PDF received!\n📝 Pages: {pages}\n💾 Size: {human_readable_size(size)}\nSaved as: `{os.path.basename(local_path)}`"
+        f"📄 PDF received!\n📝 Pages: {pages}\n💾 Size: {human_readable_size(size)}\nFile: `{doc.file_name}`"
     )
 
 # ----------------------------
@@ -224,25 +604,57 @@ async def handle_pdf_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @require_pdf
 async def cmd_clean(update: Update, context: ContextTypes.DEFAULT_TYPE):
     pdf = context.user_data["last_pdf"]
-    out = pdf.replace(".pdf", "_clean.pdf")
-    async def task():
+    pdf_hash = context.user_data.get("pdf_hash")
+    name = context.user_data.get("pdf_name") or os.path.basename(pdf)
+    out_name = f"{os.path.splitext(name)[0]}_clean.pdf"
+    active = [os.path.abspath(pdf)]
+    ACTIVE_PATHS.update(active)
+    try:
+        try:
+            os.utime(pdf)
+        except FileNotFoundError:  # evicted since require_pdf checked it
+            await update.message.reply_text("Please upload a PDF first.")
+            return
+        await asyncio.to_thread(evict_work)
         msg = await update.message.reply_text("Cleaning PDF...")
-        progress_bar(msg, total_steps=8, action="Cleaning", speed=0.08)
-        remove_watermark(pdf, out)
-        await msg.edit_text("✔ Cleaned! Sending file...")
-        await update.message.reply_document(open(out, "rb"))
-    enqueue(lambda: asyncio.run(task()))
+        report = make_progress(msg, asyncio.get_running_loop(), action="Cleaning")
+        # Only the hash-named input is shared between users; each job writes its
+        # output into its own directory
+        job_dir = tempfile.mkdtemp(dir=WORK)
+        active.append(os.path.abspath(job_dir))
+        ACTIVE_PATHS[active[-1]] += 1
+        out = os.path.join(job_dir, "clean.pdf")
+        try:
+            await clean_pdf(pdf, out, report=report, pdf_hash=pdf_hash)
+            async with aiofiles.open(out, "rb") as f:
+                data = await f.read()
+        except Exception as e:
+            print("Error in job:", e)
+            await msg.edit_text("✖ Cleaning failed.")
+            return
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    finally:
+        ACTIVE_PATHS.subtract(active)
+        for path in active:
+            if ACTIVE_PATHS[path] <= 0:
+                del ACTIVE_PATHS[path]
+    await msg.edit_text("✔ Cleaned! Sending file...")
+    await update.message.reply_document(data, filename=out_name)
 
 # ----------------------------
 # Main function
 # ----------------------------
-import asyncio
-
 def main():
     if not TOKEN:
         print("ERROR: BOT_TOKEN not set")
         return
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = (
+        ApplicationBuilder().token(TOKEN)
+        .concurrent_updates(True)  # long jobs await EXEC, which bounds the CPU work
+        .post_init(post_init).post_shutdown(post_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.Document.PDF, handle_pdf_upload))